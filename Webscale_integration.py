@@ -1,5 +1,70 @@
+import demistomock as demisto  # noqa: F401
+from CommonServerPython import *  # noqa: F401
+
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+from typing import Any, Dict, Iterator, List, Optional
+
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib json module
+    orjson = None
+
 # Disable insecure warnings
-requests.packages.urlib3.disable_warnings()  # pylint: disable=no-member
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+''' CONSTANTS '''
+
+REQUEST_TIMEOUT = 30
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 20
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUS_LIST = [429, 500, 502, 503, 504]
+RETRY_AFTER_STATUS_LIST = [413, 429, 503]
+BULK_MAX_WORKERS = 10
+HTTP2_MAX_CONNECTIONS = 100
+HTTP2_MAX_KEEPALIVE_CONNECTIONS = 20
+
+
+''' HELPER FUNCTIONS '''
+
+
+def _json_loads(content: bytes) -> Any:
+    """Decodes a JSON response body, with orjson when it is installed"""
+
+    return orjson.loads(content) if orjson else json.loads(content)
+
+
+def _json_dumps(obj: Any) -> bytes:
+    """Encodes a JSON request body, with orjson when it is installed"""
+
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+
+def _retry_delay(response: Any, attempt: int) -> float:
+    """Seconds to wait before retry ``attempt``: the response's Retry-After when given, else backoff with full jitter"""
+
+    if response is not None and response.status_code in RETRY_AFTER_STATUS_LIST:
+        retry_after = response.headers.get('Retry-After', '').strip()
+        if retry_after.isdigit():
+            return float(retry_after)
+        if retry_after:
+            try:
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+
+    return random.uniform(0, RETRY_BACKOFF_FACTOR * (2 ** attempt))
 
 
 ''' CLIENT CLASS '''
@@ -7,13 +72,111 @@ requests.packages.urlib3.disable_warnings()  # pylint: disable=no-member
 
 class Client(BaseClient):
     def __init__(self, base_url: str, api_key: str):
-        super().__init__(base_url=base_url)
+        super().__init__(base_url=base_url, timeout=REQUEST_TIMEOUT)
 
         self.api_key = api_key
 
         if self.api_key:
             self._headers = {"Authorization": "Bearer {}".format(self.api_key)}
 
+        # Reuse keep-alive connections across calls instead of a new TCP/TLS handshake per request
+        # raise_on_status=False hands the last failed response to BaseClient's error handling, as _implement_retry does
+        retry = Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF_FACTOR, status_forcelist=RETRY_STATUS_LIST,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+        self._session.mount('https://', adapter)
+        if self._headers:
+            self._session.headers.update(self._headers)
+
+        # Build the URL templates and request headers once instead of on every call
+        self._url_sets = self._base_url.rstrip('/') + '/address-sets'
+        self._url_set = self._url_sets + '/{}'
+        self._url_members = self._url_set + '/addresses'
+        self._json_headers = {**(self._headers or {}), 'Content-Type': 'application/json'}
+
+    def __enter__(self) -> 'Client':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._session.close()
+
+    def _create_http2_client(self) -> Optional[Any]:
+        """Returns an httpx client speaking HTTP/2, or None when httpx or h2 is not installed
+
+        requests has no HTTP/2 support, so the bulk fan-out goes through a single httpx client whose requests
+        are multiplexed as streams over one TLS connection.
+        """
+        try:
+            import h2  # noqa: F401
+            import httpx
+        except ImportError:
+            return None
+
+        limits = httpx.Limits(max_connections=HTTP2_MAX_CONNECTIONS,
+                              max_keepalive_connections=HTTP2_MAX_KEEPALIVE_CONNECTIONS)
+
+        return httpx.Client(headers=self._headers, verify=self._verify, http2=True, limits=limits,
+                            timeout=REQUEST_TIMEOUT)
+
+    def _get_address_set_members_http2(self, http2_client: Any, id: str) -> Dict[str, Any]:
+        """Same as get_address_set_members, sent over the HTTP/2 client
+
+        Like the session's Retry, 429/5xx responses and connection errors are retried up to RETRY_TOTAL times,
+        waiting for Retry-After when the API sends it and for a jittered exponential backoff otherwise. Failures
+        raise a DemistoException like BaseClient does.
+        """
+        import httpx
+
+        url = self._url_members.format(id)
+        for attempt in range(RETRY_TOTAL + 1):
+            last_attempt = attempt == RETRY_TOTAL
+            try:
+                response = http2_client.get(url)
+            except httpx.HTTPError as exception:
+                if last_attempt:
+                    raise DemistoException(f'Connection error in API call to {url}: {exception}', exception)
+                response = None
+            else:
+                if response.status_code not in RETRY_STATUS_LIST or last_attempt:
+                    break
+            time.sleep(_retry_delay(response, attempt))
+
+        if not response.is_success:
+            raise DemistoException(
+                f'Error in API call [{response.status_code}] - {response.reason_phrase}\n{response.text}',
+                res=response
+            )
+
+        try:
+            return _json_loads(response.content)
+        except ValueError as exception:
+            raise DemistoException(f'Failed to parse json object from response: {response.content!r}', exception)
+
+    def _json_request(self, method: str, full_url: str, json_data: Any = None) -> Any:
+        """Sends the request through BaseClient, encoding and decoding the JSON bodies with orjson when available"""
+
+        data = None
+        headers = None
+        if json_data is not None:
+            data = _json_dumps(json_data)
+            headers = self._json_headers
+
+        content = self._http_request(
+            method=method,
+            full_url=full_url,
+            data=data,
+            headers=headers,
+            resp_type='content'
+        )
+
+        if not content:
+            return {}
+
+        try:
+            return _json_loads(content)
+        except ValueError as exception:
+            raise DemistoException(f'Failed to parse json object from response: {content!r}', exception)
+
     def get_address_sets(self) -> Dict[str, Any]:
         """Returns all the address sets associated with the caller's account by sending a GET request
 
@@ -22,9 +185,9 @@ class Client(BaseClient):
 
         """
 
-        return self._http_request(
+        return self._json_request(
             method='GET',
-            url_suffix='/address-sets'
+            full_url=self._url_sets
         )
 
     def get_address_set(self, id: str) -> Dict[str, Any]:
@@ -37,9 +200,9 @@ class Client(BaseClient):
             Dict containing the address set config as returned from the API
         """
 
-        return self._http_request(
+        return self._json_request(
             method='GET',
-            url_suffix=f'/address-sets/{id}'
+            full_url=self._url_set.format(id)
         )
 
     def get_address_set_members(self, id: str) -> Dict[str, Any]:
@@ -52,30 +215,98 @@ class Client(BaseClient):
             Dict containing the IP addresses as returned from the API
         """
 
-        return self._http_request(
+        return self._json_request(
             method='GET',
-            url_suffix=f'/address-sets/{id}/addresses'
+            full_url=self._url_members.format(id)
         )
 
-    def get_address_set_add_member(self, id: str, address: str, entries) -> Dict[str, Any]:
-        """Add IP address to the specified address set by sending a PATCH request
+    def iter_address_set_members(self, id: str) -> Iterator[Dict[str, Any]]:
+        """Stream the IP addresses from the specified address set, parsing the response body incrementally
 
         Args:
             id: The address set id. You can get the address set id's associated with the caller's account by running !webscale-address-sets
-            address: The IP address to add to the address set
+
+        Returns:
+            Iterator over the IP address entries as returned from the API
+        """
+
+        import ijson
+
+        response = self._http_request(
+            method='GET',
+            full_url=self._url_members.format(id),
+            resp_type='response',
+            stream=True
+        )
+        with response:
+            response.raw.decode_content = True
+            yield from ijson.items(response.raw, 'item')
+
+    def is_address_set_member(self, id: str, address: str) -> bool:
+        """Check whether the IP address is in the specified address set
+
+        Streams the members and stops reading the response as soon as the address is found. Without ijson the
+        members are fetched in full instead.
+        """
+
+        try:
+            import ijson  # noqa: F401
+        except ImportError:
+            members = self.get_address_set_members(id)
+        else:
+            members = self.iter_address_set_members(id)
+
+        return any(item['address'] == address for item in members)
+
+    def get_address_sets_bulk(self, ids: List[str]) -> Dict[str, Any]:
+        """Get the IP addresses of several address sets by sending the GET requests concurrently
+
+        The requests share one HTTP/2 connection when httpx and h2 are installed, and the pooled requests
+        session otherwise.
+
+        Args:
+            ids: The address set ids. You can get the address set id's associated with the caller's account by running !webscale-address-sets
+
+        Returns:
+            Dict mapping each address set id to its IP addresses as returned from the API
+        """
+
+        # each id is fetched once, even if it is passed more than once
+        ids = list(dict.fromkeys(ids))
+
+        # create the HTTP/2 client before fanning out so all workers share it
+        http2_client = self._create_http2_client()
+        if http2_client is None:
+            fetch = self.get_address_set_members
+        else:
+            fetch = partial(self._get_address_set_members_http2, http2_client)
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(BULK_MAX_WORKERS, len(ids) or 1)) as executor:
+                # map keeps the results in the order of ids, not of completion
+                return dict(zip(ids, executor.map(fetch, ids)))
+        finally:
+            if http2_client is not None:
+                http2_client.close()
+
+    def get_address_set_add_member(self, id: str, entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Add IP addresses to the specified address set by sending a PATCH request
+
+        Args:
+            id: The address set id. You can get the address set id's associated with the caller's account by running !webscale-address-sets
+            entries: The full list of entries of the address set, including the IP addresses to add
 
         Returns:
             Dict containing the IP addresses as returned from the API
         """
 
-        return self._http_request(
+        return self._json_request(
             method='PATCH',
-            url_suffix=f'/address-sets/{id}',
+            full_url=self._url_set.format(id),
             json_data={"entries": entries}
         )
 
 
-
 ''' COMMAND FUNCTIONS '''
 
 
@@ -130,67 +361,113 @@ def get_address_set_command(client: Client, id: str) -> CommandResults:
                           )
     
 
-def get_address_set_members_command(client: Client, id: str, address: str) -> CommandResults:
-    response = client.get_address_set_member(id)
+def get_address_set_members_command(client: Client, id: str) -> CommandResults:
+    response = client.get_address_set_members(id)
 
-    readable_output = tableToMarkdown('IP Addressesin Address Set', response)
+    readable_output = tableToMarkdown('IP Addresses in Address Set', response)
 
-    readable CommandResults(outputs_prefix='Webscale Address Set IP Addresses',
-                            raw_response=response,
-                            readable_output=readable_output
-                            )
+    return CommandResults(outputs_prefix='Webscale Address Set IP Addresses',
+                          raw_response=response,
+                          readable_output=readable_output
+                          )
     
 
-def get_address_set_is_member_command(client: Client, id: str, address: str) -> bool:
-    response = client.get_address_set_members(id)
-    is_member = False
+def get_address_sets_members_command(client: Client, ids: List[str]) -> CommandResults:
+    response = client.get_address_sets_bulk(ids)
 
-    for item in response:
-        if item['address'] == address:
-            is_member = True
+    readable_output = '\n'.join(tableToMarkdown(f'IP Addresses in Address Set {id}', members)
+                                for id, members in response.items())
 
-    return is_member
-    
+    return CommandResults(outputs_prefix='Webscale Address Sets IP Addresses',
+                          raw_response=response,
+                          readable_output=readable_output
+                          )
 
-def get_address_set_is_blocked_command(client: Client, id: str, address: str) -> bool:
 
-    return get_address_set_is_member_command(client, id, address)
+def _is_in_set(client: Client, set_id: str, address: str) -> bool:
+    return client.is_address_set_member(set_id, address)
 
-    
-def get_address_set_is_throttled_command(client: Client, id: str, address: str) -> bool:
 
-    return get_address_set_is_member_command(client, id, address)
+def _new_entries(current: List[Dict[str, Any]], addresses: List[str]) -> List[Dict[str, Any]]:
+    """Returns the entries to append for the addresses that are not already in ``current``"""
+
+    have = {entry['address']: entry for entry in current}
+    new = []
+    for address in addresses:
+        if address not in have:
+            have[address] = entry = {"address": address, "description": "Added by Cortex XSOAR"}
+            new.append(entry)
+
+    return new
 
 
 def get_address_set_add_member_command(client: Client, id: str, address: str) -> CommandResults:
-    if get_address_set_is_member_command(client, id, address) == False:
+    current = client.get_address_set_members(id)
+    new = _new_entries(current, [address])
 
-        entries = client.get_address_set_members(id)
+    if not new:
+        demisto.debug(f"IP address {address} is already a member of address set {id}")
+        # render the entries already fetched for the diff rather than requesting them again
+        readable_output = tableToMarkdown(f'{address} already a member of address set {id}', current)
 
-        entry=(
-            "address": f"(address)",
-            "description": "Added by Cortex XSOAR"
-        )
+        return CommandResults(outputs_prefix='Webscale Address Set IP Addresses',
+                              raw_response=current,
+                              readable_output=readable_output
+                              )
 
-        entries.append(entry)
+    response = client.get_address_set_add_member(id, current + new)
 
-        response = client.get_address_set_add_member(id, address, entries)
+    readable_output = tableToMarkdown('Address Set Config', response)
 
-        readable_output = tableToMarkdown('Address Set Config', response)
+    return CommandResults(outputs_prefix='Webscale Address Set',
+                          raw_response=response,
+                          readable_output=readable_output
+                          )
+
+
+def get_address_set_add_members_command(client: Client, id: str, addresses: List[str]) -> CommandResults:
+    current = client.get_address_set_members(id)
+    new = _new_entries(current, addresses)
+
+    if not new:
+        readable_output = tableToMarkdown(f'All IP addresses are already members of address set {id}', current)
 
-        return CommandResults(outputs_prefix='Webscale Address Set',
-                              raw_response=response,
+        return CommandResults(outputs_prefix='Webscale Address Set IP Addresses',
+                              raw_response=current,
                               readable_output=readable_output
                               )
 
-    else:
-        print(f"IP address {address} is already a member of address set {id}")
-        return get_address_set_members_command(client, id)
+    response = client.get_address_set_add_member(id, current + new)
+
+    readable_output = tableToMarkdown('Address Set Config', response)
+
+    return CommandResults(outputs_prefix='Webscale Address Set',
+                          raw_response=response,
+                          readable_output=readable_output
+                          )
 
 
 ''' MAIN FUNCTION '''
 
 
+# command name -> (command function, names of the arguments passed to it positionally after the client)
+DISPATCH = {
+    'test-module': (test_module, []),
+    'webscale-address-sets': (get_address_sets_command, []),
+    'webscale-address-set': (get_address_set_command, ['id']),
+    'webscale-address-set-members': (get_address_set_members_command, ['id']),
+    'webscale-address-sets-members': (get_address_sets_members_command, ['ids']),
+    'webscale-address-set-is-member': (_is_in_set, ['id', 'address']),
+    'webscale-address-set-is-blocked': (_is_in_set, ['id', 'address']),
+    'webscale-address-set-is-throttled': (_is_in_set, ['id', 'address']),
+    'webscale-address-set-add-member': (get_address_set_add_member_command, ['id', 'address']),
+    'webscale-address-set-add-members': (get_address_set_add_members_command, ['id', 'addresses']),
+}
+
+# arguments that are parsed with argToList before dispatch
+LIST_ARGS = {'ids', 'addresses'}
+
+
 def main() -> None:
     """main function, parses params and runs command functions
 
@@ -215,41 +492,37 @@ def main() -> None:
 
     demisto.debug(f'Command being called is {command}')
     try:
-        client = Client(base_url=base_url,
-                        api_key=api_key)
-
-        if command == 'test-module':
-            # This is the call made when pressing the integration Test button.
-            return_results(test_module(client))
-
-        elif command == 'webscale-address-sets':
-            return_results(get_address_sets_command(client))
-
-        elif command == 'webscale-address-set':
-            return_results(get_address_set_command(client, **args))
-
-        elif command == 'webscale-address-set-members':
-            return_results(get_address_set_members_command(client, **args))
-
-        elif command == 'webscale-address-set-is-member':
-            return_results(get_address_set_is_member_command(client, **args))
-
-        elif command == 'webscale-address-set-is-blocked':
-            return_results(get_address_set_is_blocked_command(client, **args))
-
-        elif command == 'webscale-address-set-is-throttled':
-            return_results(get_address_set_is_throttled_command(client, **args))
-
-        elif command == 'webscale-address-set-add-member':
-            return_results(get_address_set_add_member_command(client, **args))
-
-        else:
+        if command not in DISPATCH:
             raise NotImplementedError(f"command {command} is not implemented.")
 
+        # the address sets backing the blocked and throttled checks, unless an id is passed explicitly
+        default_set_id_params = {
+            'webscale-address-set-is-blocked': 'blocked_set_id',
+            'webscale-address-set-is-throttled': 'throttled_set_id',
+        }
+        if not args.get('id') and command in default_set_id_params:
+            param = default_set_id_params[command]
+            if not params.get(param):
+                raise DemistoException(f'No address set id was given and the {param} parameter is not configured')
+            args['id'] = params[param]
+
+        for key in LIST_ARGS & args.keys():
+            args[key] = argToList(args[key])
+
+        fn, keys = DISPATCH[command]
+        # empty values count as missing, e.g. addresses='' parses to []
+        missing = [key for key in keys if args.get(key) in (None, '', [])]
+        if missing:
+            raise DemistoException(f"Missing required argument(s) for {command}: {', '.join(missing)}")
+
+        with Client(base_url=base_url, api_key=api_key) as client:
+            # test-module is the call made when pressing the integration Test button.
+            return_results(fn(client, *[args[key] for key in keys]))
+
     # Log exceptions and return errors
     except Exception as e:
         demisto.error(traceback.format_exc())  # print the traceback
-        return_error("\n".join(("Failed to execute {command} command.", "Error:", str(s))))
+        return_error("\n".join((f"Failed to execute {command} command.", "Error:", str(e))))
 
 
 ''' ENTRY POINT '''
@@ -0,0 +1,392 @@
+import sys
+import time
+
+import pytest
+
+import Webscale_integration
+from CommonServerPython import DemistoException
+from Webscale_integration import Client, _new_entries, get_address_set_add_member_command
+
+BASE_URL = 'https://test.com/api'
+MEMBERS_URL = f'{BASE_URL}/address-sets/1/addresses'
+SET_URL = f'{BASE_URL}/address-sets/1'
+
+MEMBERS = [{'address': '1.1.1.1'}, {'address': '2.2.2.2'}]
+
+
+@pytest.fixture
+def client():
+    with Client(base_url=BASE_URL, api_key='key') as client:
+        yield client
+
+
+def test_session_retry_keeps_last_response(client):
+    """
+    Given:
+        - A client
+    When:
+        - Inspecting the retry policy mounted on its session
+    Then:
+        - 429/5xx are retried and the last response is returned instead of raising a RetryError
+    """
+    retry = client._session.adapters['https://'].max_retries
+
+    assert retry.total == Webscale_integration.RETRY_TOTAL
+    assert set(retry.status_forcelist) == set(Webscale_integration.RETRY_STATUS_LIST)
+    assert retry.raise_on_status is False
+
+
+@pytest.mark.parametrize('addresses, expected', [
+    (['1.1.1.1'], []),
+    (['3.3.3.3'], ['3.3.3.3']),
+    (['3.3.3.3', '3.3.3.3', '2.2.2.2', '4.4.4.4'], ['3.3.3.3', '4.4.4.4']),
+    ([], []),
+])
+def test_new_entries(addresses, expected):
+    """
+    Given:
+        - The current entries of an address set and addresses to add
+    When:
+        - Computing the entries to append
+    Then:
+        - Only addresses missing from the set are returned, once each
+    """
+    new = _new_entries(MEMBERS, addresses)
+
+    assert [entry['address'] for entry in new] == expected
+    assert all(entry['description'] == 'Added by Cortex XSOAR' for entry in new)
+
+
+def test_add_member_already_member(client, requests_mock, mocker):
+    """
+    Given:
+        - An address that is already a member of an address set
+    When:
+        - Running webscale-address-set-add-member
+    Then:
+        - The fetched entries are returned without a second GET or a PATCH, and the no-op is logged
+    """
+    get = requests_mock.get(MEMBERS_URL, json=MEMBERS)
+    patch = requests_mock.patch(SET_URL, json={})
+    debug = mocker.patch.object(Webscale_integration.demisto, 'debug')
+
+    result = get_address_set_add_member_command(client, '1', '2.2.2.2')
+
+    assert get.call_count == 1
+    assert patch.call_count == 0
+    assert result.raw_response == MEMBERS
+    assert result.outputs_prefix == 'Webscale Address Set IP Addresses'
+    assert '2.2.2.2' in debug.call_args[0][0]
+
+
+@pytest.mark.parametrize('address, expected', [('1.1.1.1', True), ('3.3.3.3', False)])
+def test_is_member_streams_members(client, requests_mock, address, expected):
+    """
+    Given:
+        - A client and an address set
+    When:
+        - Checking whether an address is a member of the set
+    Then:
+        - The members are fetched with a single GET and the result is correct
+    """
+    requests_mock.get(MEMBERS_URL, json=MEMBERS)
+
+    assert client.is_address_set_member('1', address) is expected
+    assert requests_mock.call_count == 1
+
+
+def test_json_fallback_without_orjson(client, requests_mock, mocker):
+    """
+    Given:
+        - orjson is not installed
+    When:
+        - Fetching and patching an address set
+    Then:
+        - The bodies are encoded and decoded with the stdlib json module
+    """
+    mocker.patch.object(Webscale_integration, 'orjson', None)
+    requests_mock.get(MEMBERS_URL, json=MEMBERS)
+    patch = requests_mock.patch(SET_URL, json={'entries': MEMBERS})
+
+    assert client.get_address_set_members('1') == MEMBERS
+    client.get_address_set_add_member('1', MEMBERS)
+
+    assert patch.last_request.json() == {'entries': MEMBERS}
+    assert patch.last_request.headers['Content-Type'] == 'application/json'
+
+
+@pytest.mark.parametrize('use_orjson', [True, False])
+def test_invalid_json_response(client, requests_mock, mocker, use_orjson):
+    """
+    Given:
+        - An API that answers with a non-JSON body, such as a proxy error page
+    When:
+        - Fetching the members of an address set, with and without orjson
+    Then:
+        - A DemistoException with the response content is raised
+    """
+    if not use_orjson:
+        mocker.patch.object(Webscale_integration, 'orjson', None)
+    requests_mock.get(MEMBERS_URL, text='<html>Bad Gateway</html>')
+
+    with pytest.raises(DemistoException, match='Failed to parse json object from response: .*Bad Gateway'):
+        client.get_address_set_members('1')
+
+
+def test_is_member_without_ijson(client, requests_mock, mocker):
+    """
+    Given:
+        - ijson is not installed
+    When:
+        - Checking whether an address is a member of an address set
+    Then:
+        - The members are fetched in full with a single GET
+    """
+    mocker.patch.dict(sys.modules, {'ijson': None})
+    requests_mock.get(MEMBERS_URL, json=MEMBERS)
+
+    assert client.is_address_set_member('1', '2.2.2.2')
+    assert requests_mock.call_count == 1
+
+
+def test_bulk_without_http2(client, requests_mock, mocker):
+    """
+    Given:
+        - h2 is not installed
+    When:
+        - Fetching the members of several address sets, one of them passed twice
+    Then:
+        - Each address set is fetched once over the requests session
+    """
+    mocker.patch.dict(sys.modules, {'h2': None})
+    first = requests_mock.get(MEMBERS_URL, json=MEMBERS)
+    second = requests_mock.get(f'{BASE_URL}/address-sets/2/addresses', json=[{'address': '3.3.3.3'}])
+
+    assert client.get_address_sets_bulk(['1', '2', '1']) == {'1': MEMBERS, '2': [{'address': '3.3.3.3'}]}
+    assert first.call_count == 1
+    assert second.call_count == 1
+
+
+def test_bulk_keeps_input_order(client, mocker):
+    """
+    Given:
+        - Several address sets whose requests complete in a different order than they were passed
+    When:
+        - Fetching their members in bulk
+    Then:
+        - The results are returned in the order of the ids
+    """
+    mocker.patch.object(client, '_create_http2_client', return_value=None)
+    mocker.patch.object(client, 'get_address_set_members',
+                        side_effect=lambda id: time.sleep(0.05 if id == '1' else 0) or [{'address': id}])
+
+    assert list(client.get_address_sets_bulk(['1', '2', '3'])) == ['1', '2', '3']
+
+
+@pytest.fixture
+def http2_client(client, mocker):
+    httpx = pytest.importorskip('httpx')
+    responses = {}
+
+    def handler(request):
+        response = responses[request.url.path].pop(0)
+        if isinstance(response, Exception):
+            raise response
+        status, body, *headers = response
+        return httpx.Response(status, json=body, headers=headers[0] if headers else None)
+
+    http2_client = httpx.Client(transport=httpx.MockTransport(handler))
+    mocker.patch.object(client, '_create_http2_client', return_value=http2_client)
+    sleep = mocker.patch.object(Webscale_integration.time, 'sleep')
+
+    return http2_client, responses, sleep
+
+
+def test_bulk_over_http2(client, http2_client):
+    """
+    Given:
+        - An HTTP/2 client and an address set that is rate limited once
+    When:
+        - Fetching the members of several address sets
+    Then:
+        - The 429 is retried and the HTTP/2 client is closed afterwards
+    """
+    http2_client, responses, sleep = http2_client
+    responses['/api/address-sets/1/addresses'] = [(429, {}), (200, MEMBERS)]
+    responses['/api/address-sets/2/addresses'] = [(200, [])]
+
+    assert client.get_address_sets_bulk(['1', '2']) == {'1': MEMBERS, '2': []}
+    assert http2_client.is_closed
+    client._create_http2_client.assert_called_once()
+
+
+def test_bulk_over_http2_error(client, http2_client):
+    """
+    Given:
+        - An HTTP/2 client and an address set that does not exist
+    When:
+        - Fetching the members of the address set
+    Then:
+        - A DemistoException with the status code is raised
+    """
+    http2_client, responses, sleep = http2_client
+    responses['/api/address-sets/1/addresses'] = [(404, {'error': 'not found'})]
+
+    with pytest.raises(DemistoException, match=r'\[404\]'):
+        client.get_address_sets_bulk(['1'])
+
+
+def test_bulk_over_http2_retry_after(client, http2_client):
+    """
+    Given:
+        - An HTTP/2 client and an address set that is rate limited with a Retry-After header
+    When:
+        - Fetching the members of the address set
+    Then:
+        - The retry waits for the number of seconds the API asked for
+    """
+    http2_client, responses, sleep = http2_client
+    responses['/api/address-sets/1/addresses'] = [(429, {}, {'Retry-After': '2'}), (200, MEMBERS)]
+
+    assert client.get_address_sets_bulk(['1']) == {'1': MEMBERS}
+    sleep.assert_called_once_with(2.0)
+
+
+def test_bulk_over_http2_connection_error(client, http2_client):
+    """
+    Given:
+        - An HTTP/2 client whose connection fails once and then keeps timing out
+    When:
+        - Fetching the members of two address sets
+    Then:
+        - The transient failure is retried, and the persistent one raises a DemistoException
+    """
+    import httpx
+
+    http2_client, responses, sleep = http2_client
+    responses['/api/address-sets/1/addresses'] = [httpx.ConnectError('refused'), (200, MEMBERS)]
+    responses['/api/address-sets/2/addresses'] = [httpx.ReadTimeout('timed out')] * (Webscale_integration.RETRY_TOTAL + 1)
+
+    with pytest.raises(DemistoException, match='Connection error in API call .*timed out'):
+        client.get_address_sets_bulk(['1', '2'])
+
+    assert responses['/api/address-sets/1/addresses'] == []
+    assert responses['/api/address-sets/2/addresses'] == []
+
+
+def test_retry_delay():
+    """
+    Given:
+        - Failed responses with and without a Retry-After header
+    When:
+        - Computing how long to wait before the next attempt
+    Then:
+        - Retry-After is honoured for 429/503, otherwise the backoff is jittered and bounded
+    """
+    class Response:
+        def __init__(self, status_code, headers):
+            self.status_code = status_code
+            self.headers = headers
+
+    assert Webscale_integration._retry_delay(Response(503, {'Retry-After': '5'}), 0) == 5.0
+    assert Webscale_integration._retry_delay(Response(429, {'Retry-After': 'Thu, 01 Jan 1970 00:00:00 GMT'}), 0) == 0.0
+    delays = {Webscale_integration._retry_delay(Response(500, {'Retry-After': '5'}), 2) for _ in range(20)}
+    assert all(0 <= delay <= Webscale_integration.RETRY_BACKOFF_FACTOR * 4 for delay in delays)
+    assert len(delays) > 1
+    assert 0 <= Webscale_integration._retry_delay(None, 0) <= Webscale_integration.RETRY_BACKOFF_FACTOR
+
+
+@pytest.fixture
+def run_main(mocker):
+    def run(command, args, params=None):
+        mocker.patch.object(Webscale_integration.demisto, 'command', return_value=command)
+        mocker.patch.object(Webscale_integration.demisto, 'args', return_value=args)
+        mocker.patch.object(Webscale_integration.demisto, 'params',
+                            return_value={'url': BASE_URL, 'apikey': {'password': 'key'}, **(params or {})})
+        return_results = mocker.patch.object(Webscale_integration, 'return_results')
+        return_error = mocker.patch.object(Webscale_integration, 'return_error')
+        Webscale_integration.main()
+        return return_results, return_error
+
+    return run
+
+
+def test_main_dispatches_command(requests_mock, run_main):
+    """
+    Given:
+        - The webscale-address-set-add-members command with a comma separated list of addresses
+    When:
+        - Running main
+    Then:
+        - The addresses are parsed into a list and only the new one is added
+    """
+    requests_mock.get(MEMBERS_URL, json=MEMBERS)
+    patch = requests_mock.patch(SET_URL, json={})
+
+    return_results, return_error = run_main('webscale-address-set-add-members',
+                                            {'id': '1', 'addresses': '2.2.2.2, 3.3.3.3'})
+
+    assert patch.last_request.json()['entries'][-1]['address'] == '3.3.3.3'
+    return_results.assert_called_once()
+    return_error.assert_not_called()
+
+
+@pytest.mark.parametrize('command, args, missing', [
+    ('webscale-address-set', {}, 'id'),
+    ('webscale-address-set', {'id': ''}, 'id'),
+    ('webscale-address-sets-members', {'ids': ''}, 'ids'),
+    ('webscale-address-set-add-members', {'id': '1', 'addresses': ''}, 'addresses'),
+    ('webscale-address-set-add-members', {'id': '1', 'addresses': ' , '}, 'addresses'),
+])
+def test_main_missing_argument(requests_mock, run_main, command, args, missing):
+    """
+    Given:
+        - A command with a required argument that is absent or empty
+    When:
+        - Running main
+    Then:
+        - An error naming the missing argument is returned and no request is sent
+    """
+    return_results, return_error = run_main(command, args)
+
+    assert f'{command}: {missing}' in return_error.call_args[0][0]
+    return_results.assert_not_called()
+    assert not requests_mock.called
+
+
+@pytest.mark.parametrize('command, params, expected', [
+    ('webscale-address-set-is-blocked', {'blocked_set_id': '1'}, False),
+    ('webscale-address-set-is-throttled', {'throttled_set_id': '1'}, True),
+])
+def test_main_default_set_id(requests_mock, run_main, command, params, expected):
+    """
+    Given:
+        - An is-blocked/is-throttled command without an id and the matching set id parameter configured
+    When:
+        - Running main
+    Then:
+        - The membership is checked against the configured address set
+    """
+    requests_mock.get(MEMBERS_URL, json=MEMBERS)
+    address = '1.1.1.1' if expected else '9.9.9.9'
+
+    return_results, return_error = run_main(command, {'address': address}, params)
+
+    return_results.assert_called_once_with(expected)
+    return_error.assert_not_called()
+
+
+def test_main_default_set_id_not_configured(requests_mock, run_main):
+    """
+    Given:
+        - The is-blocked command without an id and no blocked_set_id parameter
+    When:
+        - Running main
+    Then:
+        - An error naming the parameter is returned and no request is sent
+    """
+    return_results, return_error = run_main('webscale-address-set-is-blocked', {'address': '1.1.1.1'})
+
+    assert 'blocked_set_id' in return_error.call_args[0][0]
+    return_results.assert_not_called()
+    assert not requests_mock.called